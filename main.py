@@ -4,6 +4,8 @@ import os
 
 from dotenv import load_dotenv
 
+import payments
+import tracing
 from openai_helper import OpenAIHelper
 from telegram_bot import ChatGPT3TelegramBot
 
@@ -36,6 +38,9 @@ def main():
         'assistant_prompt': os.environ.get('ASSISTANT_PROMPT', 'You are a helpful assistant,who might be a psychologist. You was created by programmer Pavel Bardin.'),
         'max_tokens': int(os.environ.get('MAX_TOKENS', 3000)),
 
+        # Seconds after which a request to the OpenAI API is abandoned
+        'request_timeout': int(os.environ.get('OPENAI_REQUEST_TIMEOUT_SECONDS', 60)),
+
         # 'gpt-3.5-turbo' or 'gpt-3.5-turbo-0301'
         'model': 'gpt-3.5-turbo',
 
@@ -63,7 +68,37 @@ def main():
         'allowed_user_ids': os.environ.get('ALLOWED_TELEGRAM_USER_IDS', '*'),
         'proxy': os.environ.get('PROXY', None),
         'voice_reply_transcript': os.environ.get('VOICE_REPLY_WITH_TRANSCRIPT_ONLY', 'true').lower() == 'true',
+
+        # Seconds to wait for in-flight updates on shutdown, below docker's default 10s stop grace period
+        'shutdown_timeout': float(os.environ.get('SHUTDOWN_TIMEOUT_SECONDS', 8)),
+    }
+
+    tracing_config = {
+        'enabled': os.environ.get('TRACING_ENABLED', 'false').lower() == 'true',
+
+        # Share of updates whose spans are written, between 0 and 1.
+        'sample_rate': float(os.environ.get('TRACING_SAMPLE_RATE', 0.1)),
+
+        # Updates slower than this are always written, even when not sampled.
+        'slow_threshold_ms': int(os.environ.get('TRACING_SLOW_THRESHOLD_MS', 5000)),
+
+        # 'jsonl' (one span per line) or 'chrome' (loadable in chrome://tracing or ui.perfetto.dev)
+        'format': os.environ.get('TRACING_FORMAT', 'jsonl').lower(),
+        'path': os.environ.get('TRACING_PATH', 'traces.jsonl'),
+        'max_bytes': int(os.environ.get('TRACING_MAX_BYTES', 10 * 1024 * 1024)),
+        'backup_count': int(os.environ.get('TRACING_BACKUP_COUNT', 3)),
     }
+    tracing.configure(config=tracing_config)
+
+    yookassa_values = ['YOOKASSA_ACCOUNT_ID', 'YOOKASSA_SECRET_KEY']
+    missing_values = [value for value in yookassa_values if os.environ.get(value) is None]
+    if len(missing_values) > 0:
+        logging.warning(f'The following environment values are missing in your .env, '
+                        f'subscriptions can not be bought: {", ".join(missing_values)}')
+    payments.configure(
+        account_id=os.environ.get('YOOKASSA_ACCOUNT_ID'),
+        secret_key=os.environ.get('YOOKASSA_SECRET_KEY')
+    )
 
     # Setup and run ChatGPT and Telegram bot
     openai_helper = OpenAIHelper(config=openai_config)
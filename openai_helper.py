@@ -1,7 +1,10 @@
+import asyncio
 import datetime
 import logging
 import openai
 
+import tracing
+
 
 #файл записывается в ворд, но и отправляется сразу
 #должен отправляться только после команды /word
@@ -22,7 +25,7 @@ class OpenAIHelper:
         self.conversations: dict[int: list] = {}  # {chat_id: history}
         self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
 
-    def get_chat_response(self, chat_id: int, query: str) -> str:
+    async def get_chat_response(self, chat_id: int, query: str) -> str:
         """
         Gets a response from the GPT-3 model.
         :param chat_id: The chat ID
@@ -39,7 +42,8 @@ class OpenAIHelper:
             if len(self.conversations[chat_id]) > self.config['max_history_size']:
                 logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
                 try:
-                    summary = self.__summarise(self.conversations[chat_id])
+                    with tracing.span('openai.summarise', history_size=len(self.conversations[chat_id])):
+                        summary = await self.__summarise(self.conversations[chat_id])
                     logging.debug(f'Summary: {summary}')
                     self.reset_chat_history(chat_id)
                     self.__add_to_history(chat_id, role="assistant", content=summary)
@@ -49,15 +53,19 @@ class OpenAIHelper:
 
             self.__add_to_history(chat_id, role="user", content=query)
 
-            response = openai.ChatCompletion.create(
-                model=self.config['model'],
-                messages=self.conversations[chat_id],
-                temperature=self.config['temperature'],
-                n=self.config['n_choices'],
-                max_tokens=self.config['max_tokens'],
-                presence_penalty=self.config['presence_penalty'],
-                frequency_penalty=self.config['frequency_penalty'],
-            )
+            with tracing.span('openai.chat_completion', model=self.config['model']) as span:
+                response = await openai.ChatCompletion.acreate(
+                    model=self.config['model'],
+                    messages=self.conversations[chat_id],
+                    temperature=self.config['temperature'],
+                    n=self.config['n_choices'],
+                    max_tokens=self.config['max_tokens'],
+                    presence_penalty=self.config['presence_penalty'],
+                    frequency_penalty=self.config['frequency_penalty'],
+                    request_timeout=self.config['request_timeout'],
+                )
+                if span is not None:
+                    span.set(total_tokens=response.usage['total_tokens'])
 
             if len(response.choices) > 0:
                 answer = ''
@@ -96,25 +104,29 @@ class OpenAIHelper:
             logging.exception(e)
             return f"⚠️ Что-то не так с запросом... ⚠️\nНажмите на /reset и введите запрос заново"
 
-    def generate_image(self, prompt: str) -> str:
+    async def generate_image(self, prompt: str) -> str:
         """
         Generates an image from the given prompt using DALL·E model.
         :param prompt: The prompt to send to the model
         :return: The image URL
         """
-        response = openai.Image.create(
-            prompt=prompt,
-            n=1,
-            size=self.config['image_size']
-        )
+        with tracing.span('openai.image', size=self.config['image_size']):
+            # Image.acreate would send `request_timeout` as a request parameter, so bound it here instead
+            response = await asyncio.wait_for(openai.Image.acreate(
+                prompt=prompt,
+                n=1,
+                size=self.config['image_size']
+            ), timeout=self.config['request_timeout'])
         return response['data'][0]['url']
 
-    def transcribe(self, filename):
+    async def transcribe(self, filename):
         """
         Transcribes the audio file using the Whisper model.
         """
-        with open(filename, "rb") as audio:
-            result = openai.Audio.transcribe("whisper-1", audio)
+        with tracing.span('openai.transcribe'), open(filename, "rb") as audio:
+            # Audio.atranscribe would send `request_timeout` as a form field, so bound it here instead
+            result = await asyncio.wait_for(openai.Audio.atranscribe("whisper-1", audio),
+                                            timeout=self.config['request_timeout'])
             return result.text
 
     def reset_chat_history(self, chat_id):
@@ -145,7 +157,7 @@ class OpenAIHelper:
         """
         self.conversations[chat_id].append({"role": role, "content": content})
 
-    def __summarise(self, conversation) -> str:
+    async def __summarise(self, conversation) -> str:
         """
         Summarises the conversation history.
         :param conversation: The conversation history
@@ -155,9 +167,10 @@ class OpenAIHelper:
             { "role": "assistant", "content": "Summarize this conversation in 700 characters or less" },
             { "role": "user", "content": str(conversation) }
         ]
-        response = openai.ChatCompletion.create(
+        response = await openai.ChatCompletion.acreate(
             model=self.config['model'],
             messages=messages,
-            temperature=0.4
+            temperature=0.4,
+            request_timeout=self.config['request_timeout'],
         )
         return response.choices[0]['message']['content']
@@ -1,15 +1,33 @@
 import time
 import uuid
+from functools import cache
 from json import loads
 
-from yookassa import Configuration, Payment
+_config = {}
 
-Configuration.account_id = '206380'
-Configuration.secret_key = 'live_tPsGRmcSZ0BFI44fGPTHTls7odjFGb9MD2a-ysDe6X0'
+
+def configure(account_id: str, secret_key: str):
+    """
+    Stores the YooKassa credentials. The SDK itself is imported and configured on first use,
+    so importing this module stays cheap.
+    """
+    _config.update(account_id=account_id, secret_key=secret_key)
+    _payment.cache_clear()
+
+
+@cache
+def _payment():
+    from yookassa import Configuration, Payment
+
+    if not _config.get('account_id') or not _config.get('secret_key'):
+        raise RuntimeError('YooKassa credentials are not configured')
+    Configuration.account_id = _config['account_id']
+    Configuration.secret_key = _config['secret_key']
+    return Payment
 
 
 def create_payment(summ: int, description: str):
-    payment = Payment.create({
+    payment = _payment().create({
         "amount": {
             "value": str(summ),
             "currency": "RUB"
@@ -28,7 +46,7 @@ def create_payment(summ: int, description: str):
 
 
 def get_payment_status(id: str):
-    response = Payment.find_one(payment_id=id)
+    response = _payment().find_one(payment_id=id)
     if loads(response.json())['status'] in 'succeeded':
         return True
     else:
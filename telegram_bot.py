@@ -1,23 +1,74 @@
 import asyncio
+import contextvars
 import logging
 import os
+import signal
+import threading
+from functools import wraps
 
 import telegram.constants as constants
 from telegram import Update, InlineQueryResultArticle, InputTextMessageContent, InlineKeyboardMarkup, \
     InlineKeyboardButton
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters, InlineQueryHandler, \
+from telegram.ext import Application, ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters, InlineQueryHandler, \
     CallbackQueryHandler
 
 import payments
+import tracing
 
-logging.basicConfig(level=logging.INFO)
 from openai_helper import OpenAIHelper
-from pydub import AudioSegment
-from docx import Document
 import datetime
 import json
 
 
+def write_json(path: str, data: dict):
+    """
+    Atomically writes the data to a JSON file, so a shutdown can never leave it half-written.
+    """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking call in a daemon thread, so it neither stalls the event loop nor holds up
+    the process exit when its handler is abandoned on shutdown.
+    Every call starts its own thread and the number of threads is not limited. Updates are
+    handled one at a time, so normally at most one runs, but a call whose handler was cancelled
+    keeps its thread until the call returns.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    context = contextvars.copy_context()
+
+    def resolve(result, exception):
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def target():
+        result, exception = None, None
+        try:
+            result = context.run(func, *args, **kwargs)
+        except Exception as e:
+            exception = e
+        except BaseException as e:
+            # SystemExit and the like would stop the event loop once re-raised by the awaiting task
+            exception = RuntimeError(f'{getattr(func, "__name__", func)} raised {e!r}')
+            exception.__cause__ = e
+        try:
+            loop.call_soon_threadsafe(resolve, result, exception)
+        except RuntimeError:
+            pass  # The event loop is already closed
+
+    threading.Thread(target=target, daemon=True).start()
+    return await future
+
+
 class ChatGPT3TelegramBot:
     """
     Class representing a Chat-GPT3 Telegram Bot.
@@ -35,45 +86,52 @@ class ChatGPT3TelegramBot:
         self.hours_dict = {'day': 24, 'month': 720, '6month': 4320, 'year': 8760}
         self.prices_dict = {'day': 99, 'month': 390, '6month': 690, 'year': 990}
         self.name_dict = {'day': '1 день подписки', 'month': "1 месяц подписки", '6month': "6 месяцев подписки", 'year': "1 год подписки"}
+        self.background_tasks: list[asyncio.Task] = []
+        self.in_flight: set[asyncio.Task] = set()
 
     async def help(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Shows the help menu.
         """
-        with open('userlist.json', 'r') as file:
-            data = json.loads(file.read())
-        try:
-            _ = data[str(update.effective_chat.id)]
-        except KeyError:
-            data[str(update.effective_chat.id)] = [10, 0]
-            with open('userlist.json', 'w', encoding='utf-8') as file:
-                json.dump(data, file, indent=4, ensure_ascii=False)
-        await update.message.reply_text(
-            "Привет! Я бот, который поможет тебе в учебе. Напиши что нужно сделать и я займусь этим!\n\n"
+        with tracing.span('register_user'):
+            with open('userlist.json', 'r') as file:
+                data = json.loads(file.read())
+            try:
+                _ = data[str(update.effective_chat.id)]
+            except KeyError:
+                data[str(update.effective_chat.id)] = [10, 0]
+                write_json('userlist.json', data)
+        with tracing.span('telegram.send_help'):
+            await update.message.reply_text(
+                "Привет! Я бот, который поможет тебе в учебе. Напиши что нужно сделать и я займусь этим!\n\n"
 
 
-            "/image - 🌅 Чтобы сгенерировать изображение, начните свой запрос с /image. Работает в тестовом режиме на английском языке\n"
-            "/word - После того как вы получили ответ от бота - отправьте сообщение /word и бот предоставит свой ответ в формате файла word\n"
-            "/reset - сбросить предыдущие ответы бота",
-            disable_web_page_preview=True)
+                "/image - 🌅 Чтобы сгенерировать изображение, начните свой запрос с /image. Работает в тестовом режиме на английском языке\n"
+                "/word - После того как вы получили ответ от бота - отправьте сообщение /word и бот предоставит свой ответ в формате файла word\n"
+                "/reset - сбросить предыдущие ответы бота",
+                disable_web_page_preview=True)
 
     async def reset(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Resets the conversation.
         """
         chat_id = update.effective_chat.id
-        if not await self.is_allowed(chat_id, context):
+        with tracing.span('is_allowed'):
+            allowed = await self.is_allowed(chat_id, context)
+        if not allowed:
             logging.warning(f'User {update.message.from_user.name} is not allowed to use the bot')
             keyb = InlineKeyboardMarkup([[InlineKeyboardButton(text='Купить подписку', callback_data='subscription')]])
-            await update.message.reply_text(text="Извини, но у тебя нет доступа к боту. Для покупки подписки нажми на "
-                                                 "кнопку ниже.", reply_markup=keyb)
+            with tracing.span('telegram.send_disallowed_notice'):
+                await update.message.reply_text(text="Извини, но у тебя нет доступа к боту. Для покупки подписки нажми на "
+                                                     "кнопку ниже.", reply_markup=keyb)
             return
 
         logging.info(f'Resetting the conversation for user {update.message.from_user.name}...')
 
         chat_id = update.effective_chat.id
         self.openai.reset_chat_history(chat_id=chat_id)
-        await context.bot.send_message(chat_id=chat_id, text='Done!')
+        with tracing.span('telegram.send_response'):
+            await context.bot.send_message(chat_id=chat_id, text='Done!')
 
     async def image(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
@@ -86,96 +144,117 @@ class ChatGPT3TelegramBot:
         chat_id = update.effective_chat.id
         image_query = update.message.text.replace('/image', '').strip()
         if image_query == '':
-            await context.bot.send_message(chat_id=chat_id, text='Please provide a prompt!')
+            with tracing.span('telegram.send_response'):
+                await context.bot.send_message(chat_id=chat_id, text='Please provide a prompt!')
             return
 
-        await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
+        with tracing.span('telegram.send_chat_action'):
+            await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
 
-        message = await context.bot.send_message(chat_id=chat_id, text='Подождите, я печатаю...')
+        with tracing.span('telegram.send_typing_notice'):
+            message = await context.bot.send_message(chat_id=chat_id, text='Подождите, я печатаю...')
 
         try:
-            image_url = self.openai.generate_image(prompt=image_query)
-            await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-            await context.bot.send_photo(
-                chat_id=chat_id,
-                reply_to_message_id=update.message.message_id,
-                photo=image_url
-            )
+            image_url = await self.openai.generate_image(prompt=image_query)
+            with tracing.span('telegram.delete_typing_notice'):
+                await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+            with tracing.span('telegram.send_photo'):
+                await context.bot.send_photo(
+                    chat_id=chat_id,
+                    reply_to_message_id=update.message.message_id,
+                    photo=image_url
+                )
         except Exception as e:
             logging.exception(e)
-            await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-            await context.bot.send_message(
-                chat_id=chat_id,
-                reply_to_message_id=update.message.message_id,
-                text=f'Failed to generate image: {str(e)}'
-            )
+            with tracing.span('telegram.delete_typing_notice'):
+                await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+            with tracing.span('telegram.send_error'):
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    reply_to_message_id=update.message.message_id,
+                    text=f'Failed to generate image: {str(e)}'
+                )
 
     async def transcribe(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Transcribe audio messages.
         """
         chat_id = update.effective_chat.id
-        if not await self.is_allowed(chat_id, context):
+        with tracing.span('is_allowed'):
+            allowed = await self.is_allowed(chat_id, context)
+        if not allowed:
             logging.warning(f'User {update.message.from_user.name} is not allowed to use the bot')
             keyb = InlineKeyboardMarkup([[InlineKeyboardButton(text='Купить подписку', callback_data='subscription')]])
-            await update.message.reply_text(text="Извини, но у тебя нет доступа к боту. Для покупки подписки нажми на "
-                                                 "кнопку ниже.", reply_markup=keyb)
+            with tracing.span('telegram.send_disallowed_notice'):
+                await update.message.reply_text(text="Извини, но у тебя нет доступа к боту. Для покупки подписки нажми на "
+                                                     "кнопку ниже.", reply_markup=keyb)
             return
 
         if not update.message.voice and not update.message.audio:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                reply_to_message_id=update.message.message_id,
-                text='Unsupported file type'
-            )
+            with tracing.span('telegram.send_error'):
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id,
+                    reply_to_message_id=update.message.message_id,
+                    text='Unsupported file type'
+                )
             return
 
         logging.info(f'New transcribe request received from user {update.message.from_user.name}')
 
         chat_id = update.effective_chat.id
-        await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
+        with tracing.span('telegram.send_chat_action'):
+            await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
         filename = update.message.voice.file_unique_id if update.message.voice else update.message.audio.file_unique_id
         filename_ogg = f'{filename}.ogg'
         filename_mp3 = f'{filename}.mp3'
 
         try:
             if update.message.voice:
-                audio_file = await context.bot.get_file(update.message.voice.file_id)
-                await audio_file.download_to_drive(filename_ogg)
-                ogg_audio = AudioSegment.from_ogg(filename_ogg)
-                ogg_audio.export(filename_mp3, format="mp3")
+                from pydub import AudioSegment
+
+                with tracing.span('telegram.download_audio'):
+                    audio_file = await context.bot.get_file(update.message.voice.file_id)
+                    await audio_file.download_to_drive(filename_ogg)
+                with tracing.span('pydub.convert_ogg_to_mp3'):
+                    ogg_audio = await run_blocking(AudioSegment.from_ogg, filename_ogg)
+                    await run_blocking(ogg_audio.export, filename_mp3, format="mp3")
 
             elif update.message.audio:
-                audio_file = await context.bot.get_file(update.message.audio.file_id)
-                await audio_file.download_to_drive(filename_mp3)
+                with tracing.span('telegram.download_audio'):
+                    audio_file = await context.bot.get_file(update.message.audio.file_id)
+                    await audio_file.download_to_drive(filename_mp3)
 
             # Transcribe the audio file
-            transcript = self.openai.transcribe(filename_mp3)
+            transcript = await self.openai.transcribe(filename_mp3)
 
             if self.config['voice_reply_transcript']:
                 # Send the transcript
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    reply_to_message_id=update.message.message_id,
-                    text=f'_Transcript:_\n"{transcript}"',
-                    parse_mode=constants.ParseMode.MARKDOWN
-                )
+                with tracing.span('telegram.send_response'):
+                    await context.bot.send_message(
+                        chat_id=chat_id,
+                        reply_to_message_id=update.message.message_id,
+                        text=f'_Transcript:_\n"{transcript}"',
+                        parse_mode=constants.ParseMode.MARKDOWN
+                    )
             else:
                 # Send the response of the transcript
-                response = self.openai.get_chat_response(chat_id=chat_id, query=transcript)
+                with tracing.span('openai.get_chat_response'):
+                    response = await self.openai.get_chat_response(chat_id=chat_id, query=transcript)
+                with tracing.span('telegram.send_response', length=len(response)):
+                    await context.bot.send_message(
+                        chat_id=chat_id,
+                        reply_to_message_id=update.message.message_id,
+                        text=f'_Transcript:_\n"{transcript}"\n\n_Answer:_\n{response}',
+                        parse_mode=constants.ParseMode.MARKDOWN
+                    )
+        except Exception as e:
+            logging.exception(e)
+            with tracing.span('telegram.send_error'):
                 await context.bot.send_message(
                     chat_id=chat_id,
                     reply_to_message_id=update.message.message_id,
-                    text=f'_Transcript:_\n"{transcript}"\n\n_Answer:_\n{response}',
-                    parse_mode=constants.ParseMode.MARKDOWN
+                    text=f'Что то не так с голосовым сообщением! Попробуй записать еще раз'
                 )
-        except Exception as e:
-            logging.exception(e)
-            await context.bot.send_message(
-                chat_id=chat_id,
-                reply_to_message_id=update.message.message_id,
-                text=f'Что то не так с голосовым сообщением! Попробуй записать еще раз'
-            )
         finally:
             # Cleanup files
             if os.path.exists(filename_mp3):
@@ -187,6 +266,8 @@ class ChatGPT3TelegramBot:
         """
         Generates a docx file and saves it on the server.
         """
+        from docx import Document
+
         if os.path.exists(f'{chat_id}.docx'):
             os.remove(f'{chat_id}.docx')
         document = Document()
@@ -196,7 +277,8 @@ class ChatGPT3TelegramBot:
     async def word(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
         # Send the response as a document
-        await context.bot.send_document(chat_id=chat_id, document=open(f"{chat_id}.docx", "rb"))
+        with tracing.span('telegram.send_document'), open(f"{chat_id}.docx", "rb") as document:
+            await context.bot.send_document(chat_id=chat_id, document=document)
         if os.path.exists(f'{chat_id}.docx'):
             os.remove(f'{chat_id}.docx')
 
@@ -205,28 +287,36 @@ class ChatGPT3TelegramBot:
         Handles incoming messages and generates a response using GPT-3.
         """
         chat_id = update.effective_chat.id
-        if not await self.is_allowed(chat_id, context):
+        with tracing.span('is_allowed'):
+            allowed = await self.is_allowed(chat_id, context)
+        if not allowed:
             logging.warning(f'User {update.message.from_user.name} is not allowed to use the bot')
             keyb = InlineKeyboardMarkup([[InlineKeyboardButton(text='Купить подписку', callback_data='subscription')]])
-            await update.message.reply_text(text="Извини, но у тебя нет доступа к боту. Для покупки подписки нажми на "
-                                                 "кнопку ниже.", reply_markup=keyb)
+            with tracing.span('telegram.send_disallowed_notice'):
+                await update.message.reply_text(text="Извини, но у тебя нет доступа к боту. Для покупки подписки нажми на "
+                                                     "кнопку ниже.", reply_markup=keyb)
             return
 
         logging.info(f'New prompt received from user {update.message.from_user.name}')
 
         # Send "Подождите" notification to the user
-        message = await context.bot.send_message(chat_id=chat_id, text="Подождите, я печатаю...")
+        with tracing.span('telegram.send_typing_notice'):
+            message = await context.bot.send_message(chat_id=chat_id, text="Подождите, я печатаю...")
 
         # Generate a response
-        response = self.openai.get_chat_response(chat_id=chat_id, query=update.message.text)
+        with tracing.span('openai.get_chat_response'):
+            response = await self.openai.get_chat_response(chat_id=chat_id, query=update.message.text)
 
         # Remove the "Подождите" notification
-        await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+        with tracing.span('telegram.delete_typing_notice'):
+            await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
 
-        await context.bot.send_message(chat_id=chat_id, text=response)
+        with tracing.span('telegram.send_response', length=len(response)):
+            await context.bot.send_message(chat_id=chat_id, text=response)
 
         # Generate a docx file and save it on the server
-        self.word1(chat_id, response)
+        with tracing.span('word1'):
+            await run_blocking(self.word1, chat_id, response)
 
     async def inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -247,7 +337,8 @@ class ChatGPT3TelegramBot:
             )
         ]
 
-        await update.inline_query.answer(results)
+        with tracing.span('telegram.answer_inline_query'):
+            await update.inline_query.answer(results)
 
     async def send_disallowed_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
@@ -270,22 +361,28 @@ class ChatGPT3TelegramBot:
                  [InlineKeyboardButton(text=f'1 месяц', callback_data=f'price-month')],
                  [InlineKeyboardButton(text=f'6 месяцев', callback_data=f'price-6month')],
                  [InlineKeyboardButton(text=f'1 Год', callback_data=f'price-year')]]
-        await update.callback_query.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(board))
+        with tracing.span('telegram.edit_reply_markup'):
+            await update.callback_query.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(board))
 
     async def buying_subscription(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.callback_query.answer()
+        with tracing.span('telegram.answer_callback_query'):
+            await update.callback_query.answer()
         sum = self.prices_dict[update.callback_query.data.split('-')[1]]
         text = self.name_dict[update.callback_query.data.split('-')[1]]
-        buy = payments.create_payment(summ=sum, description=f'{text}')
+        with tracing.span('payments.create_payment', amount=sum):
+            buy = await run_blocking(payments.create_payment, summ=sum, description=f'{text}')
         hours = self.hours_dict[update.callback_query.data.split('-')[1]]
         keyb = InlineKeyboardMarkup([[InlineKeyboardButton(text=f'{sum} Рублей за {text}', url=buy[0])],
                                      [InlineKeyboardButton(text='Проверить оплату', callback_data=f'checkoplata__{buy[1]}__{hours}')],
                                      [InlineKeyboardButton(text='К выбору подписки', callback_data='backbuttonsub')]])
-        await update.callback_query.message.edit_reply_markup(keyb)
+        with tracing.span('telegram.edit_reply_markup'):
+            await update.callback_query.message.edit_reply_markup(keyb)
 
     async def applying_sub(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         id = update.callback_query.data.split('__')[1]
-        if payments.get_payment_status(id):
+        with tracing.span('payments.get_payment_status', payment_id=id):
+            paid = await run_blocking(payments.get_payment_status, id)
+        if paid:
             try:
                 self.date_writer(update.effective_chat.id, id, int(update.callback_query.data.split('__')[2]), self.prices_dict[[k for k,v in self.hours_dict.items() if v == int(update.callback_query.data.split('__')[2])][0]])
             except Exception as _EX:
@@ -295,11 +392,12 @@ class ChatGPT3TelegramBot:
                 data = json.loads(file.read())
             try:
                 data[str(update.effective_chat.id)][1] = data[str(update.effective_chat.id)][1] + int(update.callback_query.data.split('__')[2])
-                with open('userlist.json', 'w', encoding='utf-8') as file:
-                    json.dump(data, file, indent=4, ensure_ascii=False)
-                await update.callback_query.message.delete()
+                write_json('userlist.json', data)
+                with tracing.span('telegram.delete_message'):
+                    await update.callback_query.message.delete()
                 days = int(update.callback_query.data.split('__')[2])//24
-                await update.callback_query.message.reply_text(f"Ты успешно оплатил подписку на {days}{' дня' if str(days)[-1] in ['2', '3', '4'] else ' день' if str(days)[-1] in ['1'] else ' дней'}")
+                with tracing.span('telegram.send_response'):
+                    await update.callback_query.message.reply_text(f"Ты успешно оплатил подписку на {days}{' дня' if str(days)[-1] in ['2', '3', '4'] else ' день' if str(days)[-1] in ['1'] else ' дней'}")
             except KeyError:
                 pass
 
@@ -337,8 +435,7 @@ class ChatGPT3TelegramBot:
                     await context.bot.send_message(chat_id= chat_id, text=f'Закончились беспланые сообщения...')
 
                 data[str(chat_id)][0] -= 1
-                with open('userlist.json', 'w', encoding='utf-8') as file:
-                    json.dump(data, file, indent=4, ensure_ascii=False)
+                write_json('userlist.json', data)
                 print(22)
                 return True
             else:
@@ -352,36 +449,119 @@ class ChatGPT3TelegramBot:
             data = json.loads(file.read())
         data[str(pay_id)] = [str(chat_id), str(hours), str(summ),
                              f"{datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S')}"]
-        with open('subscriptions.json', 'w', encoding='utf-8') as file:
-            json.dump(data, file, indent=4, ensure_ascii=False)
+        write_json('subscriptions.json', data)
 
 
     def run(self):
         """
-        Runs the bot indefinitely until the user presses Ctrl+C
+        Runs the bot indefinitely until the user presses Ctrl+C or the process receives SIGTERM
         """
         application = ApplicationBuilder() \
             .token(self.config['token']) \
             .proxy_url(self.config['proxy']) \
             .get_updates_proxy_url(self.config['proxy']) \
+            .post_init(self.post_init) \
+            .post_stop(self.post_stop) \
+            .post_shutdown(self.post_shutdown) \
             .build()
 
-        application.add_handler(CommandHandler('reset', self.reset))
-        application.add_handler(CommandHandler('start', self.help))
-        application.add_handler(CommandHandler('image', self.image))
-        application.add_handler(CommandHandler('word', self.word))
-        application.add_handler(MessageHandler(filters.VOICE | filters.AUDIO, self.transcribe))
-        application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), self.prompt))
-        application.add_handler(InlineQueryHandler(self.inline_query, chat_types=[
+        application.add_handler(CommandHandler('reset', self.__handler(self.reset)))
+        application.add_handler(CommandHandler('start', self.__handler(self.help)))
+        application.add_handler(CommandHandler('image', self.__handler(self.image)))
+        application.add_handler(CommandHandler('word', self.__handler(self.word)))
+        application.add_handler(MessageHandler(filters.VOICE | filters.AUDIO, self.__handler(self.transcribe)))
+        application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), self.__handler(self.prompt)))
+        application.add_handler(InlineQueryHandler(self.__handler(self.inline_query), chat_types=[
             constants.ChatType.GROUP, constants.ChatType.SUPERGROUP
         ]))
-        application.add_handler(CallbackQueryHandler(self.subscription, 'subscription'))
-        application.add_handler(CallbackQueryHandler(self.buying_subscription, 'price-'))
-        application.add_handler(CallbackQueryHandler(self.applying_sub, 'checkoplata__'))
-        application.add_handler(CallbackQueryHandler(self.subscription, 'backbuttonsub'))
+        application.add_handler(CallbackQueryHandler(self.__handler(self.subscription), 'subscription'))
+        application.add_handler(CallbackQueryHandler(self.__handler(self.buying_subscription), 'price-'))
+        application.add_handler(CallbackQueryHandler(self.__handler(self.applying_sub), 'checkoplata__'))
+        application.add_handler(CallbackQueryHandler(self.__handler(self.subscription), 'backbuttonsub'))
         application.add_error_handler(self.error_handler)
 
-        application.run_polling()
+        asyncio.run(self.__serve(application))
+
+    async def post_init(self, application: Application):
+        """
+        Starts the background jobs once the application is initialized.
+        """
+        self.background_tasks.append(asyncio.create_task(task()))
+
+    async def post_stop(self, application: Application):
+        """
+        Cancels the background jobs once no more updates are handled.
+        """
+        for background_task in self.background_tasks:
+            background_task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        self.background_tasks.clear()
+
+    async def post_shutdown(self, application: Application):
+        """
+        Flushes the pending traces once the application is shut down.
+        """
+        tracing.get_tracer().close()
+
+    def __handler(self, callback):
+        """
+        Wraps a handler callback so that every update it handles is traced and runs in its own task,
+        which is cancelled if it is still running when the shutdown deadline passes.
+        """
+        @wraps(callback)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            handler_task = asyncio.create_task(callback(update, context))
+            self.in_flight.add(handler_task)
+            try:
+                return await handler_task
+            finally:
+                self.in_flight.discard(handler_task)
+
+        return tracing.traced_update(wrapper)
+
+    async def __serve(self, application: Application):
+        """
+        Runs the application lifecycle, like `Application.run_polling`, but bounds the time
+        spent draining in-flight updates on shutdown by `shutdown_timeout` seconds.
+        """
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(stop_signal, stop_event.set)
+            except NotImplementedError:
+                pass  # Windows, Ctrl+C still raises KeyboardInterrupt
+
+        try:
+            await application.initialize()
+            await application.post_init(application)
+            await application.updater.start_polling()
+            await application.start()
+            logging.info('Bot started')
+            await stop_event.wait()
+        finally:
+            logging.info('Shutting down...')
+            # post_stop and post_shutdown must run even if a step before them fails,
+            # they stop the background jobs and flush the pending traces
+            try:
+                try:
+                    if application.updater.running:
+                        await application.updater.stop()
+                    if application.running:
+                        try:
+                            await asyncio.wait_for(application.stop(), timeout=self.config['shutdown_timeout'])
+                        except asyncio.TimeoutError:
+                            logging.warning(f'In-flight updates did not finish within {self.config["shutdown_timeout"]}s, '
+                                            f'cancelling them')
+                            in_flight = list(self.in_flight)
+                            for handler_task in in_flight:
+                                handler_task.cancel()
+                            await asyncio.gather(*in_flight, return_exceptions=True)
+                finally:
+                    await application.post_stop(application)
+                await application.shutdown()
+            finally:
+                await application.post_shutdown(application)
 
 
 
@@ -393,10 +573,6 @@ async def task():
         for i, v in data.items():
             if v[1] > 0:
                 data[i][1] = v[1] - 1
-        with open('userlist.json', 'w', encoding='utf-8') as file:
-            json.dump(data, file, indent=4, ensure_ascii=False)
+        write_json('userlist.json', data)
         await asyncio.sleep(3600)
 
-
-loop = asyncio.get_event_loop()
-loop.create_task(task())
@@ -0,0 +1,276 @@
+import contextvars
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+
+
+class _Trace:
+    """
+    Spans of a single incoming update, buffered until the root span finishes.
+    """
+
+    def __init__(self, trace_id: str, lane: int, sampled: bool):
+        self.trace_id = trace_id
+        self.lane = lane
+        self.sampled = sampled
+        self.spans: list[dict] = []
+        self.open_spans: dict[str, Span] = {}  # {span_id: span}, spans that have not finished yet
+        self.failed = False
+
+
+class Span:
+    """
+    A single timed stage inside a trace.
+    """
+
+    def __init__(self, trace: _Trace, name: str, parent_id: str | None, attrs: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.start = time.time()
+        self._start_perf = time.perf_counter()
+        self.duration = 0.0
+
+    def set(self, **attrs):
+        """
+        Adds attributes to the span.
+        """
+        self.attrs.update(attrs)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start_perf
+
+    def finish(self):
+        self.duration = self.elapsed()
+
+
+_current_trace: contextvars.ContextVar[_Trace | None] = contextvars.ContextVar('current_trace', default=None)
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar('current_span', default=None)
+
+
+class Tracer:
+    """
+    Lightweight tracer writing sampled update traces to a rotating local file.
+    """
+
+    def __init__(self, config: dict):
+        """
+        Initializes the tracer with the given configuration.
+        :param config: A dictionary containing the tracing configuration
+        """
+        self.config = config
+        self.lock = threading.Lock()
+        self.pending: dict[str, _Trace] = {}  # {trace_id: trace}
+        self.file = None
+        self.closed = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.config['enabled']
+
+    @contextmanager
+    def trace(self, name: str, **attrs):
+        """
+        Opens the root span of a new trace, e.g. for an incoming update.
+        Traces are kept if they were sampled, took longer than the slow threshold or if any of
+        their spans failed, even when the error was caught further up, e.g. an OpenAI request
+        timing out or an update cancelled on shutdown. Traces still running when the tracer is
+        closed are always kept, marked as incomplete.
+        """
+        if not self.enabled or _current_trace.get() is not None:
+            with self.span(name, **attrs) as span:
+                yield span
+            return
+
+        with self.lock:
+            lanes_in_use = {pending.lane for pending in self.pending.values()}
+            trace = _Trace(
+                trace_id=uuid.uuid4().hex,
+                lane=next(lane for lane in itertools.count(1) if lane not in lanes_in_use),
+                sampled=random.random() < self.config['sample_rate']
+            )
+            self.pending[trace.trace_id] = trace
+        trace_token = _current_trace.set(trace)
+        try:
+            with self.span(name, **attrs) as span:
+                yield span
+        finally:
+            _current_trace.reset(trace_token)
+            with self.lock:
+                self.pending.pop(trace.trace_id, None)
+            slow = span.duration * 1000 >= self.config['slow_threshold_ms']
+            if trace.sampled or slow or trace.failed:
+                self.__export(trace)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """
+        Opens a child span of the current trace. Does nothing outside of a trace.
+        """
+        trace = _current_trace.get()
+        if trace is None:
+            yield None
+            return
+
+        parent = _current_span.get()
+        span = Span(trace, name, parent.span_id if parent else None, attrs)
+        trace.open_spans[span.span_id] = span
+        span_token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=f'{type(e).__name__}: {e}')
+            trace.failed = True
+            raise
+        finally:
+            span.finish()
+            _current_span.reset(span_token)
+            trace.open_spans.pop(span.span_id, None)
+            trace.spans.append(self.__to_record(span))
+
+    def traced_update(self, callback):
+        """
+        Wraps a telegram handler callback so that every update it handles opens a new trace.
+        """
+        @wraps(callback)
+        async def wrapper(update, context):
+            attrs = {'handler': callback.__name__}
+            if getattr(update, 'update_id', None) is not None:
+                attrs['update_id'] = update.update_id
+            if getattr(update, 'effective_chat', None) is not None:
+                attrs['chat_id'] = update.effective_chat.id
+            with self.trace(f'update.{callback.__name__}', **attrs):
+                return await callback(update, context)
+
+        return wrapper
+
+    def close(self):
+        """
+        Writes the traces that are still running as incomplete and closes the trace file.
+        Traces finishing after this are dropped.
+        """
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for trace in pending:
+            self.__export(trace, incomplete=True)
+
+        with self.lock:
+            self.closed = True
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def __to_record(self, span: Span, incomplete: bool = False) -> dict:
+        """
+        Converts a span to a record in the configured output format.
+        :param span: The span
+        :param incomplete: Whether the span is still running, its duration is then the time elapsed so far
+        :return: A JSONL record or a Chrome trace event
+        """
+        duration = span.elapsed() if incomplete else span.duration
+        attrs = {**span.attrs, 'incomplete': True} if incomplete else span.attrs
+        if self.config['format'] == 'chrome':
+            return {
+                'name': span.name,
+                'cat': 'bot',
+                'ph': 'X',
+                'ts': int(span.start * 1_000_000),
+                'dur': int(duration * 1_000_000),
+                'pid': os.getpid(),
+                'tid': span.trace.lane,
+                'args': {'trace_id': span.trace.trace_id, **attrs},
+            }
+        return {
+            'trace_id': span.trace.trace_id,
+            'span_id': span.span_id,
+            'parent_id': span.parent_id,
+            'name': span.name,
+            'start': span.start,
+            'duration_ms': round(duration * 1000, 3),
+            'attrs': attrs,
+        }
+
+    def __export(self, trace: _Trace, incomplete: bool = False):
+        """
+        Writes the spans of a trace to the trace file.
+        :param trace: The trace
+        :param incomplete: Whether the trace is still running, its open spans are then written as well
+        """
+        records = list(trace.spans)
+        if incomplete:
+            records += [self.__to_record(span, incomplete=True) for span in list(trace.open_spans.values())]
+        suffix = ',' if self.config['format'] == 'chrome' else ''
+        lines = ''.join(json.dumps(record, ensure_ascii=False, default=str) + suffix + '\n'
+                        for record in records)
+        try:
+            with self.lock:
+                if self.closed:
+                    return
+                if self.file is None or self.file.tell() >= self.config['max_bytes']:
+                    self.__rotate()
+                self.file.write(lines)
+                self.file.flush()
+        except OSError as e:
+            logging.warning(f'Error while writing trace {trace.trace_id}: {str(e)}')
+
+    def __rotate(self):
+        """
+        Rotates the trace file, keeping at most `backup_count` old files.
+        The Chrome trace format may omit the closing bracket, so every file stays loadable on its own.
+        """
+        path = self.config['path']
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            for index in range(self.config['backup_count'] - 1, 0, -1):
+                if os.path.exists(f'{path}.{index}'):
+                    os.replace(f'{path}.{index}', f'{path}.{index + 1}')
+            if self.config['backup_count'] > 0:
+                os.replace(path, f'{path}.1')
+            else:
+                os.remove(path)
+
+        self.file = open(path, 'a', encoding='utf-8')
+        if self.config['format'] == 'chrome' and self.file.tell() == 0:
+            self.file.write('[\n')
+
+
+_tracer = Tracer(config={'enabled': False})
+
+
+def configure(config: dict) -> Tracer:
+    """
+    Configures the process-wide tracer.
+    :param config: A dictionary containing the tracing configuration
+    :return: The configured tracer
+    """
+    global _tracer
+    _tracer.close()
+    _tracer = Tracer(config=config)
+    return _tracer
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def trace(name: str, **attrs):
+    return _tracer.trace(name, **attrs)
+
+
+def span(name: str, **attrs):
+    return _tracer.span(name, **attrs)
+
+
+def traced_update(callback):
+    return _tracer.traced_update(callback)